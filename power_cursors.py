@@ -1,37 +1,210 @@
 import sublime, sublime_plugin
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import attrgetter, eq, ne
 
 _TRANSITION_CURSOR_SCOPE_TYPE = 'transition_cursor'
 _TRANSITION_CURSOR_ICON       = 'dot'
 _TRANSITION_CURSOR_FLAGS      = sublime.DRAW_EMPTY | sublime.DRAW_NO_FILL | sublime.PERSISTENT
 
+_SETTINGS_FILE = 'PowerCursors.sublime-settings'
+
+# Settings of the package, kept up to date by `plugin_loaded`
+_settings = None
+_remove_picks_nearest = True
+
+# Position of the cursor kept alive by `power_cursor_add` within its region
+_ALIVE_POS_FUNCS = {
+    "a":     attrgetter("a"),
+    "b":     attrgetter("b"),
+    "begin": sublime.Region.begin,
+    "end":   sublime.Region.end,
+}
+
+# Comparisons for the operators of the `in_cursor_transition` context; any
+# other operator just reports the transition state
+_OP_TABLE = {
+    sublime.OP_EQUAL:     eq,
+    sublime.OP_NOT_EQUAL: ne,
+}
+
+# Below this many transition cursors a plain scan is cheaper than bisecting
+_BISECT_THRESHOLD = 16
+
+# Cached transition state of each view, keyed by view id
+_STATE = {}
+
+
+#### Settings ####
+
+def plugin_loaded():
+    """Load the settings once the API is ready and follow their changes.
+    """
+    global _settings
+    _settings = sublime.load_settings(_SETTINGS_FILE)
+    _settings.add_on_change("remove_picks_nearest", update_settings)
+    update_settings()
+
+def plugin_unloaded():
+    """Stop following the settings.
+    """
+    if _settings is not None:
+        _settings.clear_on_change("remove_picks_nearest")
+
+def update_settings():
+    """Read the settings used on the command hot paths.
+    """
+    global _remove_picks_nearest
+    _remove_picks_nearest = _settings.get("remove_picks_nearest", True)
+
+
+#### Cached transition state of a view ####
+
+class _ViewState:
+    """Transition state of a view that would otherwise be read back from the
+    view on every command and key event.
+    The cached regions are only valid for the buffer change count they were
+    read or written at, since edits move them. Their beginnings and ends are
+    only packed into arrays of 64-bit offsets once a search bisects them.
+    """
+    __slots__ = ("regions", "begins", "ends", "change_count", "in_transition")
+
+    def __init__(self, view):
+        self.regions = None
+        self.begins = None
+        self.ends = None
+        self.change_count = None
+        # Persistent regions outlive the plugin, so ask the view; this is
+        # refreshed whenever the regions are read back from it
+        self.in_transition = len(view.get_regions("transition_sels")) > 0
+
+def get_state(view):
+    """Get the cached transition state of `view`, creating it if needed.
+    """
+    state = _STATE.get(view.id())
+    if state is None:
+        state = _ViewState(view)
+        # Persistent regions may not be restored yet while the view is loading
+        if not view.is_loading():
+            _STATE[view.id()] = state
+    return state
+
 
 #### Helper functions for adding and restoring selections ####
 
 def set_transition_sels(view, sels):
     """Set the updated transition selections and marks.
+    `sels` must be sorted and merged the way the view stores them, so they
+    can be cached for the next command instead of being read back.
     """
     view.add_regions("transition_sels", sels,
                      scope = _TRANSITION_CURSOR_SCOPE_TYPE,
                      icon  = _TRANSITION_CURSOR_ICON,
                      flags = _TRANSITION_CURSOR_FLAGS)
 
-def find_prev_sel(trans_sels, current_sel):
+    state = get_state(view)
+    state.regions = sels
+    state.begins = state.ends = None
+    state.change_count = view.change_count()
+    state.in_transition = len(sels) > 0
+
+def set_mark(view, pos = None):
+    """Put the mark at `pos`, or erase it if `pos` is None.
+    """
+    if pos is None:
+        view.erase_regions("mark")
+    else:
+        view.add_regions("mark", [sublime.Region(pos, pos)],
+                         "mark", "", sublime.HIDDEN | sublime.PERSISTENT)
+
+def get_transition_sels(view, with_keys = False):
+    """Get the transition selections.
+    The regions are cached until they are set again or the buffer changes.
+    With `with_keys`, also return their beginnings and ends for bisecting,
+    packed on first use, or None for lists short enough to be scanned.
+    """
+    state = get_state(view)
+    change_count = view.change_count()
+    if state.regions is None or state.change_count != change_count:
+        sels = view.get_regions("transition_sels")
+        state.regions = sels
+        state.begins = state.ends = None
+        state.change_count = change_count
+        state.in_transition = len(sels) > 0
+
+    sels = list(state.regions)
+    if not with_keys:
+        return sels
+
+    if state.begins is None and len(sels) >= _BISECT_THRESHOLD:
+        state.begins = array('q', (s.begin() for s in sels))
+        state.ends = array('q', (s.end() for s in sels))
+    return sels, state.begins, state.ends
+
+def clear_transition_sels(view):
+    """Erase all transition selections.
+    """
+    view.erase_regions("transition_sels")
+    state = get_state(view)
+    state.regions = None
+    state.in_transition = False
+
+def merge_sels(trans_sels, new_sels):
+    """Merge `new_sels` into `trans_sels` and combine the overlapping regions,
+    the same way the view sorts and merges regions added to it.
+    When both are already sorted, the sort only has to merge two runs.
+    """
+    merged = []
+    for sel in sorted(trans_sels + list(new_sels), key = lambda s: (s.begin(), s.end())):
+        if merged:
+            last = merged[-1]
+            if sel.begin() < last.end() or sel == last:
+                if sel.end() > last.end():
+                    merged[-1] = sublime.Region(last.begin(), sel.end())
+                continue
+        merged.append(sel)
+    return merged
+
+def find_prev_sel(trans_sels, current_sel, begins = None, _range = range):
     """Find the region in `trans_sels` that is right before `current_sel`.
-    Assume `trans_sels` is sorted.
+    Assume `trans_sels` is sorted and merged, so both the beginnings and the
+    ends of the regions are in ascending order and can be bisected when
+    there are enough of them to pay off. `begins` optionally holds the
+    precomputed beginnings of `trans_sels`.
     """
-    for i in range(len(trans_sels) - 1, -1, -1):
-        if trans_sels[i].begin() < current_sel.begin():
+    pos = current_sel.begin()
+    n = len(trans_sels)
+    if n < _BISECT_THRESHOLD:
+        for i in _range(n - 1, -1, -1):
+            sel = trans_sels[i]
+            if sel.begin() < pos:
+                return i, sel
+    else:
+        if begins is None:
+            begins = [s.begin() for s in trans_sels]
+        i = bisect_left(begins, pos) - 1
+        if i >= 0:
             return i, trans_sels[i]
 
     # Rotate to the last if `current_sel` is before all other selections
     return -1, trans_sels[-1]
 
-def find_next_sel(trans_sels, current_sel):
+def find_next_sel(trans_sels, current_sel, ends = None, _enumerate = enumerate):
     """Find the region in `trans_sels` that is right after `current_sel`.
-    Assume `trans_sels` is sorted.
+    Assume `trans_sels` is sorted and merged. `ends` optionally holds the
+    precomputed ends of `trans_sels`.
     """
-    for i, sel in enumerate(trans_sels):
-        if sel.end() > current_sel.end():
+    pos = current_sel.end()
+    n = len(trans_sels)
+    if n < _BISECT_THRESHOLD:
+        for i, sel in _enumerate(trans_sels):
+            if sel.end() > pos:
+                return i, sel
+    else:
+        if ends is None:
+            ends = [s.end() for s in trans_sels]
+        i = bisect_right(ends, pos)
+        if i < n:
             return i, trans_sels[i]
 
     # Rotate to the beginning if `current_sel` is after all other selections
@@ -47,62 +220,65 @@ class PowerCursorAddCommand(sublime_plugin.TextCommand):
         view = self.view
 
         # Store the current selection
-        current_sels = [s for s in view.sel()]
-        trans_sels = view.get_regions("transition_sels")
-        trans_sels.extend(current_sels)
+        current_sels = view.sel()
+        trans_sels = merge_sels(get_transition_sels(view), current_sels)
         set_transition_sels(view, trans_sels)
 
         # Keep one current cursor alive, depending on the given args
-        view.erase_regions("mark")
-        view.sel().clear()
         try:
             alive_sel = current_sels[keep_alive_cursor_index]
-            alive_pos = {
-                "a": alive_sel.a,
-                "b": alive_sel.b,
-                "begin": alive_sel.begin(),
-                "end": alive_sel.end(),
-            }[keep_alive_cursor_position]
-        except Exception:
+            alive_pos = _ALIVE_POS_FUNCS[keep_alive_cursor_position](alive_sel)
+        except (IndexError, KeyError, TypeError):
             # Fail safe
             alive_sel = current_sels[-1]
             alive_pos = alive_sel.b
 
-        view.sel().add(sublime.Region(alive_pos, alive_pos))
+        set_mark(view)
+        current_sels.clear()
+        current_sels.add(sublime.Region(alive_pos, alive_pos))
 
 class PowerCursorRemoveCommand(sublime_plugin.TextCommand):
-    """Remove the current transition cursor and switch back to the previous one.
+    """Remove the current transition cursor and switch back to the previous one,
+    or to whichever of the previous and the next one is closer if the
+    `remove_picks_nearest` setting is on.
     """
     def run(self, edit):
         view = self.view
 
         # Retrieve the transition selections
-        trans_sels = view.get_regions("transition_sels")
+        current_sels = view.sel()
+        trans_sels, begins, ends = get_transition_sels(view, with_keys = True)
         if len(trans_sels) == 0:
             return
 
-        # Activate the selection that is closest to the current selection(s)
-        # in terms of lines
-        last_index, last_sel = find_prev_sel(trans_sels, view.sel()[0])
-        next_index, next_sel = find_next_sel(trans_sels, view.sel()[-1])
-
-        last_row, last_col = view.rowcol(last_sel.end())
-        next_row, next_col = view.rowcol(next_sel.begin())
-        start_row, start_col = view.rowcol(view.sel()[0].begin())
-        end_row, end_col = view.rowcol(view.sel()[-1].end())
-        if abs(start_row - last_row) < abs(next_row - end_row):
-            index, new_sel = last_index, last_sel
+        if len(trans_sels) == 1:
+            # The only transition cursor is both the previous and the next one
+            index, new_sel = 0, trans_sels[0]
+            last_sel = new_sel
         else:
-            index, new_sel = next_index, next_sel
+            first_sel, end_sel = current_sels[0], current_sels[-1]
+            last_index, last_sel = find_prev_sel(trans_sels, first_sel, begins)
+            index, new_sel = last_index, last_sel
+
+            if _remove_picks_nearest:
+                # Activate the selection that is closest to the current
+                # selection(s) in terms of lines
+                next_index, next_sel = find_next_sel(trans_sels, end_sel, ends)
 
-        view.sel().clear()
-        view.sel().add(new_sel)
+                # Nothing to compare if both searches found the same region
+                if next_sel != last_sel:
+                    start, end = first_sel.begin(), end_sel.end()
+                    last_row = view.rowcol(last_sel.end())[0]
+                    next_row = view.rowcol(next_sel.begin())[0]
+                    start_row = view.rowcol(start)[0]
+                    end_row = start_row if end == start else view.rowcol(end)[0]
+                    if abs(start_row - last_row) >= abs(next_row - end_row):
+                        index, new_sel = next_index, next_sel
+
+        current_sels.clear()
+        current_sels.add(new_sel)
         view.show(new_sel)
-        if new_sel.a != new_sel.b:
-            view.add_regions("mark", [sublime.Region(last_sel.a, last_sel.a)],
-                             "mark", "", sublime.HIDDEN | sublime.PERSISTENT)
-        else:
-            view.erase_regions("mark")
+        set_mark(view, last_sel.a if new_sel.a != new_sel.b else None)
 
         del(trans_sels[index])
         set_transition_sels(view, trans_sels)
@@ -114,48 +290,48 @@ class PowerCursorSelectCommand(sublime_plugin.TextCommand):
         view = self.view
 
         # Add the current selections into the transition lists
-        current_sels = [s for s in view.sel()]
-        trans_sels = view.get_regions("transition_sels")
-        trans_sels.extend(current_sels)
-
-        # Lazy step: Store the disorganized region and retrieve a sorted and
-        # merged region list
-        view.add_regions("transition_sels", trans_sels)
-        trans_sels = view.get_regions("transition_sels")
-
-        # Get the previous or next selection and mark
-        if forward:
-            index, sel = find_next_sel(trans_sels, current_sels[-1])
+        current_sels = view.sel()
+        first_sel, last_sel = current_sels[0], current_sels[-1]
+        trans_sels = get_transition_sels(view)
+
+        if not trans_sels and len(current_sels) == 1:
+            # Nothing to switch to, so the current selection stays active
+            sel = first_sel
         else:
-            index, sel = find_prev_sel(trans_sels, current_sels[0])
+            trans_sels = merge_sels(trans_sels, current_sels)
+
+            # Get the previous or next selection
+            if forward:
+                index, sel = find_next_sel(trans_sels, last_sel)
+            else:
+                index, sel = find_prev_sel(trans_sels, first_sel)
+
+            # Activate the selection and remove it from transition list
+            current_sels.clear()
+            current_sels.add(sel)
+            del(trans_sels[index])
+            set_transition_sels(view, trans_sels)
 
-        # Activate the selection
-        view.sel().clear()
-        view.sel().add(sel)
         view.show(sel)
         if sel.a != sel.b:
-            view.add_regions("mark", [sublime.Region(sel.a, sel.a)],
-                             "mark", "", sublime.HIDDEN | sublime.PERSISTENT)
-
-        # Remove it from transition list
-        del(trans_sels[index])
-        set_transition_sels(view, trans_sels)
+            set_mark(view, sel.a)
 
 class PowerCursorActivateCommand(sublime_plugin.TextCommand):
     """Activate all cursors (including the one that's currently alive).
     """
     def run(self, edit):
         view = self.view
-        sels = view.get_regions("transition_sels")
+        sels = get_transition_sels(view)
         view.sel().add_all(sels)
-        view.erase_regions("transition_sels")
-        view.erase_regions("mark")
+        clear_transition_sels(view)
+        set_mark(view)
 
 class PowerCursorExitCommand(sublime_plugin.TextCommand):
     """Clear all transition cursors and exit the transition state.
     """
     def run(self, edit):
-        self.view.erase_regions("transition_sels")
+        view = self.view
+        clear_transition_sels(view)
 
 
 class CursorTransitionListener(sublime_plugin.EventListener):
@@ -163,5 +339,12 @@ class CursorTransitionListener(sublime_plugin.EventListener):
     """
     def on_query_context(self, view, key, operator, operand, match_all):
         if key == 'in_cursor_transition':
-            in_transition = len(view.get_regions("transition_sels")) > 0
-            return in_transition == operand if operator == sublime.OP_EQUAL else in_transition
+            in_transition = get_state(view).in_transition
+            compare = _OP_TABLE.get(operator)
+            return in_transition if compare is None else compare(in_transition, operand)
+
+    def on_load(self, view):
+        _STATE.pop(view.id(), None)
+
+    def on_close(self, view):
+        _STATE.pop(view.id(), None)